@@ -1,11 +1,33 @@
 from typing import Any
-import requests
+import urllib3
+import hashlib
+import time
+import threading
 
 from dify_plugin import ToolProvider
 from dify_plugin.errors.tool import ToolProviderCredentialValidationError
 
 
+# Shared connection pool so keep-alive connections to api.upstage.ai are reused
+# across invocations instead of paying a fresh TCP+TLS handshake each time
+_http = urllib3.PoolManager(
+    num_pools=20,
+    maxsize=50,
+    block=False,
+    retries=urllib3.Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False
+    )
+)
+
+
 class UpstageToolProvider(ToolProvider):
+    # Recently validated API keys (hashed) mapped to validation time
+    _valid_cache: dict[str, float] = {}
+    _valid_lock = threading.Lock()
+    _valid_ttl = 300  # 5 minutes validation TTL
 
     def _validate_credentials(self, credentials: dict[str, Any]) -> None:
         """
@@ -20,6 +42,16 @@ class UpstageToolProvider(ToolProvider):
             if not isinstance(api_key, str) or len(api_key.strip()) == 0:
                 raise ToolProviderCredentialValidationError("Invalid Upstage API key format")
 
+            # Skip the network round trip if this key was validated recently
+            key_hash = hashlib.blake2b(api_key.strip().encode(), digest_size=16).hexdigest()
+            with self._valid_lock:
+                validated_at = self._valid_cache.get(key_hash)
+                if validated_at is not None:
+                    if time.time() - validated_at < self._valid_ttl:
+                        return
+                    # Drop the stale entry so the cache doesn't grow with every key ever seen
+                    self._valid_cache.pop(key_hash, None)
+
             # Test the API key by making a request to the Upstage API
             headers = {
                 "Authorization": f"Bearer {api_key.strip()}",
@@ -27,20 +59,32 @@ class UpstageToolProvider(ToolProvider):
             }
 
             # Make a minimal test request to validate the API key
-            response = requests.get(
+            response = _http.request(
+                "GET",
                 "https://api.upstage.ai/v1/document-digitization",
                 headers=headers,
                 timeout=10
             )
 
-            if response.status_code == 401:
+            if response.status == 401:
                 raise ToolProviderCredentialValidationError("Invalid Upstage API key. Please check your credentials.")
-            elif response.status_code == 403:
+            elif response.status == 403:
                 raise ToolProviderCredentialValidationError("Access denied. Please check your API key permissions.")
-            elif response.status_code >= 500:
+            elif response.status >= 500:
                 raise ToolProviderCredentialValidationError("Upstage API service unavailable. Please try again later.")
 
-        except requests.RequestException as e:
+            with self._valid_lock:
+                now = time.time()
+                # Prune keys that expired without being validated again
+                expired_hashes = [
+                    h for h, validated_at in self._valid_cache.items()
+                    if now - validated_at >= self._valid_ttl
+                ]
+                for h in expired_hashes:
+                    del self._valid_cache[h]
+                self._valid_cache[key_hash] = now
+
+        except urllib3.exceptions.HTTPError as e:
             raise ToolProviderCredentialValidationError(f"Failed to connect to Upstage API: {str(e)}")
         except Exception as e:
             raise ToolProviderCredentialValidationError(f"Credential validation failed: {str(e)}")
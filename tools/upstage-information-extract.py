@@ -1,73 +1,254 @@
+from collections import OrderedDict
 from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Any
-import requests
+import urllib3
 import hashlib
 import time
 import threading
-import json
+import tempfile
+import stat
+import orjson
 import base64
+import os
+from diskcache import Cache
 
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
 
+# Shared connection pool so keep-alive connections to api.upstage.ai are reused
+# across invocations instead of paying a fresh TCP+TLS handshake each time.
+# Only connection failures are retried: retrying the POST itself after a 5xx or
+# read error could bill the same document twice
+_http = urllib3.PoolManager(
+    num_pools=20,
+    maxsize=50,
+    block=False,
+    retries=urllib3.Retry(total=2, backoff_factor=0.3, read=0, status=0)
+)
+
+
+def _open_disk_cache() -> Cache | None:
+    """Open the on-disk cache in a private directory owned by this user, if possible"""
+    try:
+        root = os.path.join(tempfile.gettempdir(), f"upstage_cache_{os.getuid()}")
+        os.makedirs(root, mode=0o700, exist_ok=True)
+        # diskcache stores pickles, so refuse a directory anyone else could have planted or can read
+        info = os.lstat(root)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            return None
+        cache = Cache(
+            os.path.join(root, "information-extract"),
+            size_limit=1 << 30,
+            eviction_policy="least-recently-used"
+        )
+    except Exception:
+        return None
+    # Reading an expired key does not delete it, so drop rows left by earlier workers
+    try:
+        cache.expire()
+    except Exception:
+        pass
+    return cache
+
+
+# Second cache tier that survives plugin worker restarts
+_disk_cache = _open_disk_cache()
+
+# MIME types sent in the data URL, keyed by lowercase file extension
+_MIME_BY_EXT = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".pdf": "application/pdf",
+    ".png": "image/png"
+}
+
+# Number of independently locked memory cache shards (power of two)
+_CACHE_SHARDS = 16
+
+
 class UpstageInformationExtractTool(Tool):
-    # Class-level memory cache
-    _cache = {}
-    _cache_lock = threading.Lock()
+    # Class-level memory cache, sharded by key so lookups on different keys don't contend
+    _cache_shards: list[OrderedDict[str, dict]] = [OrderedDict() for _ in range(_CACHE_SHARDS)]
+    _cache_locks = [threading.Lock() for _ in range(_CACHE_SHARDS)]
     _cache_ttl = 3600  # 1 hour cache TTL
     _max_cache_size = 100  # Maximum number of cached items
+    _cleanup_interval = 60  # Minimum seconds between expired-entry sweeps
+    _last_cleanup = 0.0
+    _cleanup_lock = threading.Lock()
+    _request_timeout = urllib3.Timeout(connect=10, read=300)
+    # Batch limits sized for the plugin's 256 MB memory budget: each in-flight file
+    # holds roughly 4x its size (blob, base64, data URL, serialized payload)
+    _max_batch_workers = 4  # Maximum concurrent API calls in batch mode
+    _max_batch_files = 10  # Maximum number of files per batch
+    _max_batch_bytes = 32 * 1024 * 1024  # Maximum total size of a batch
+    # Events for API calls currently in progress, keyed by cache key
+    _inflight: dict[str, threading.Event] = {}
+    _inflight_lock = threading.Lock()
+    # Base64 encodings of recently sent files, reused when only the schema changes
+    _b64_cache: OrderedDict[str, dict] = OrderedDict()
+    _b64_lock = threading.Lock()
+    _b64_cache_bytes = 0  # Total length of cached encodings
+    _max_b64_cache_bytes = 16 * 1024 * 1024  # Encodings are large, so bound the total size
+    _max_b64_entry_bytes = 4 * 1024 * 1024  # Larger encodings are not cached at all
 
     @classmethod
-    def _get_cache_key(cls, file_content: bytes, schema: str) -> str:
-        """Generate cache key from file content and schema"""
-        file_hash = hashlib.md5(file_content).hexdigest()
-        schema_hash = hashlib.md5(schema.encode()).hexdigest()
+    def _get_cache_key(cls, file_hash: str, schema: str) -> str:
+        """Generate cache key from file content hash and schema"""
+        schema_hash = hashlib.blake2b(schema.encode(), digest_size=16).hexdigest()
         return f"{file_hash}_{schema_hash}"
 
+    @staticmethod
+    def _hash_file(file_obj: Any) -> str:
+        """Hash file content (Dify files only expose the fully loaded .blob)"""
+        return hashlib.blake2b(file_obj.blob, digest_size=16).hexdigest()
+
+    @classmethod
+    def _shard_of(cls, cache_key: str) -> int:
+        """Return the index of the memory cache shard holding the key"""
+        return hash(cache_key) & (_CACHE_SHARDS - 1)
+
     @classmethod
     def _get_from_cache(cls, cache_key: str) -> dict | None:
-        """Retrieve content from memory cache if valid"""
-        with cls._cache_lock:
-            if cache_key in cls._cache:
-                cached_item = cls._cache[cache_key]
+        """Retrieve content from memory cache, falling back to disk cache"""
+        index = cls._shard_of(cache_key)
+        shard = cls._cache_shards[index]
+        with cls._cache_locks[index]:
+            if cache_key in shard:
+                cached_item = shard[cache_key]
                 # Check if cache is still valid
                 if time.time() - cached_item['timestamp'] < cls._cache_ttl:
+                    # Mark as most recently used
+                    shard.move_to_end(cache_key)
                     return cached_item['content']
                 else:
                     # Remove expired cache
-                    del cls._cache[cache_key]
-        return None
+                    del shard[cache_key]
+
+        if _disk_cache is None:
+            return None
+        try:
+            content, expire_time = _disk_cache.get(cache_key, expire_time=True)
+        except Exception:
+            # The disk tier is best-effort; treat failures as a miss
+            return None
+        if content is not None:
+            # Promote to the memory cache, keeping the original expiry
+            timestamp = expire_time - cls._cache_ttl if expire_time else time.time()
+            cls._save_to_memory(cache_key, content, timestamp)
+        return content
 
     @classmethod
     def _save_to_cache(cls, cache_key: str, content: dict) -> None:
+        """Save content to memory and disk cache"""
+        cls._save_to_memory(cache_key, content, time.time())
+        if _disk_cache is not None:
+            try:
+                _disk_cache.set(cache_key, content, expire=cls._cache_ttl)
+            except Exception:
+                # The disk tier is best-effort; the memory tier still has the entry
+                pass
+
+    @classmethod
+    def _save_to_memory(cls, cache_key: str, content: dict, timestamp: float) -> None:
         """Save content to memory cache"""
-        with cls._cache_lock:
-            # Implement LRU-style cache size management
-            if len(cls._cache) >= cls._max_cache_size:
-                # Remove oldest cache entry
-                oldest_key = min(cls._cache.keys(),
-                               key=lambda k: cls._cache[k]['timestamp'])
-                del cls._cache[oldest_key]
-
-            cls._cache[cache_key] = {
+        index = cls._shard_of(cache_key)
+        shard = cls._cache_shards[index]
+        max_shard_size = cls._max_cache_size // _CACHE_SHARDS + 1
+        with cls._cache_locks[index]:
+            if cache_key in shard:
+                shard.move_to_end(cache_key)
+            elif len(shard) >= max_shard_size:
+                # Evict least recently used entry in this shard
+                shard.popitem(last=False)
+
+            shard[cache_key] = {
                 'content': content,
+                'timestamp': timestamp
+            }
+
+    @classmethod
+    def _get_encoded(cls, file_hash: str) -> str | None:
+        """Retrieve the base64 encoding of a file if it is still valid"""
+        with cls._b64_lock:
+            cached_item = cls._b64_cache.get(file_hash)
+            if cached_item is None:
+                return None
+            if time.time() - cached_item['timestamp'] >= cls._cache_ttl:
+                del cls._b64_cache[file_hash]
+                cls._b64_cache_bytes -= len(cached_item['content'])
+                return None
+            cls._b64_cache.move_to_end(file_hash)
+            return cached_item['content']
+
+    @classmethod
+    def _save_encoded(cls, file_hash: str, base64_data: str) -> None:
+        """Save the base64 encoding of a file, skipping encodings too large to keep"""
+        if len(base64_data) > cls._max_b64_entry_bytes:
+            return
+        with cls._b64_lock:
+            previous = cls._b64_cache.pop(file_hash, None)
+            if previous is not None:
+                cls._b64_cache_bytes -= len(previous['content'])
+
+            # Evict least recently used encodings until the new one fits
+            while cls._b64_cache and cls._b64_cache_bytes + len(base64_data) > cls._max_b64_cache_bytes:
+                _, evicted = cls._b64_cache.popitem(last=False)
+                cls._b64_cache_bytes -= len(evicted['content'])
+
+            cls._b64_cache[file_hash] = {
+                'content': base64_data,
                 'timestamp': time.time()
             }
+            cls._b64_cache_bytes += len(base64_data)
+
+    @classmethod
+    def _begin_inflight(cls, cache_key: str) -> threading.Event | None:
+        """Register an in-flight request, or return the event of one already running"""
+        with cls._inflight_lock:
+            event = cls._inflight.get(cache_key)
+            if event is None:
+                cls._inflight[cache_key] = threading.Event()
+            return event
+
+    @classmethod
+    def _end_inflight(cls, cache_key: str) -> None:
+        """Release callers waiting on an in-flight request"""
+        with cls._inflight_lock:
+            event = cls._inflight.pop(cache_key, None)
+        if event is not None:
+            event.set()
 
     @classmethod
     def _cleanup_expired_cache(cls) -> None:
-        """Clean up expired cache entries"""
-        with cls._cache_lock:
-            current_time = time.time()
-            expired_keys = [
-                key for key, value in cls._cache.items()
-                if current_time - value['timestamp'] >= cls._cache_ttl
-            ]
-            for key in expired_keys:
-                del cls._cache[key]
-
-    def _parse_schema(self, schema_text: str) -> dict:
+        """Clean up expired cache entries, at most once per cleanup interval"""
+        current_time = time.time()
+        with cls._cleanup_lock:
+            # Lookups already drop expired entries lazily, so a full sweep is rarely needed
+            if current_time - cls._last_cleanup < cls._cleanup_interval:
+                return
+            cls._last_cleanup = current_time
+
+        for shard, lock in zip(cls._cache_shards, cls._cache_locks):
+            with lock:
+                expired_keys = [
+                    key for key, value in shard.items()
+                    if current_time - value['timestamp'] >= cls._cache_ttl
+                ]
+                for key in expired_keys:
+                    del shard[key]
+
+        # diskcache only culls a few expired rows per write, so remove the rest explicitly
+        if _disk_cache is not None:
+            try:
+                _disk_cache.expire()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _parse_schema(schema_text: str) -> dict:
         """
         Parse extraction schema from JSON string
 
@@ -78,14 +259,15 @@ class UpstageInformationExtractTool(Tool):
             Dictionary mapping field names to descriptions
         """
         try:
-            schema = json.loads(schema_text.strip())
+            schema = orjson.loads(schema_text.strip())
             if not isinstance(schema, dict):
                 raise ValueError("Schema must be a JSON object (dictionary)")
             return schema
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             raise ValueError(f"Invalid JSON format: {str(e)}")
 
-    def _build_json_schema(self, field_definitions: dict) -> dict:
+    @staticmethod
+    def _build_json_schema(field_definitions: dict) -> dict:
         """
         Build JSON Schema for Upstage API from field definitions
 
@@ -107,85 +289,94 @@ class UpstageInformationExtractTool(Tool):
             "properties": properties
         }
 
-    def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage, None, None]:
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _compile_schema(schema_text: str) -> tuple[dict, dict]:
         """
-        Extract structured information from documents using Upstage Information Extract API
+        Parse a schema string and build its JSON Schema, memoized per schema string
 
         Args:
-            tool_parameters: Dictionary containing:
-                - file: File object to be analyzed
-                - extraction_schema: JSON string defining fields to extract
+            schema_text: JSON string defining fields to extract
 
-        Yields:
-            ToolInvokeMessage: JSON message with extracted data
+        Returns:
+            Tuple of (field definitions, JSON Schema object for API request)
         """
-        try:
-            # Extract parameters
-            file_obj = tool_parameters.get("file")
-            if not file_obj:
-                yield self.create_text_message("Error: No file provided for extraction.")
-                return
+        field_definitions = UpstageInformationExtractTool._parse_schema(schema_text)
+        json_schema = UpstageInformationExtractTool._build_json_schema(field_definitions)
+        return field_definitions, json_schema
 
-            schema_text = tool_parameters.get("extraction_schema", "")
-            if not schema_text:
-                yield self.create_text_message("Error: No extraction schema provided.")
-                return
+    def _extract_one(self, file_obj: Any, schema_text: str, json_schema: dict, api_key: str) -> dict:
+        """
+        Extract structured information from a single file, serving from cache when possible
 
-            # Get file information
-            filename = getattr(file_obj, 'filename', 'document')
+        Args:
+            file_obj: File object to be analyzed
+            schema_text: JSON string defining fields to extract (part of the cache key)
+            json_schema: JSON Schema object for API request
+            api_key: Upstage API key
 
-            # Get API key from credentials
-            api_key = self.runtime.credentials.get("upstage_api_key")
-            if not api_key:
-                yield self.create_text_message("Error: Upstage API key not found in credentials.")
-                return
+        Returns:
+            Dictionary with extracted data
 
-            # Get file content directly from blob
-            try:
-                file_content = file_obj.blob
-                if not file_content:
-                    yield self.create_text_message("Error: Failed to read file content.")
-                    return
-            except Exception as e:
-                yield self.create_text_message(f"Error reading file: {str(e)}")
-                return
+        Raises:
+            ValueError: If the file cannot be processed; the message is ready to show to the user
+        """
+        # Get file information
+        filename = getattr(file_obj, 'filename', 'document')
 
-            # Parse extraction schema
-            try:
-                field_definitions = self._parse_schema(schema_text)
-                if not field_definitions:
-                    yield self.create_text_message("Error: Extraction schema is empty.")
-                    return
-            except ValueError as e:
-                yield self.create_text_message(f"Error parsing schema: {str(e)}")
-                return
+        # Hash the file first so cache hits skip the request preparation and API call
+        try:
+            file_hash = self._hash_file(file_obj)
+        except Exception as e:
+            raise ValueError(f"Error reading file: {str(e)}")
 
-            # Generate cache key and check cache
-            cache_key = self._get_cache_key(file_content, schema_text)
-            cached_content = self._get_from_cache(cache_key)
+        # Generate cache key and check cache
+        cache_key = self._get_cache_key(file_hash, schema_text)
+        cached_content = self._get_from_cache(cache_key)
+
+        if cached_content:
+            return cached_content
+
+        # Clean up expired cache entries periodically
+        self._cleanup_expired_cache()
 
+        # Wait for an identical request already in progress instead of repeating it
+        inflight = self._begin_inflight(cache_key)
+        if inflight is not None:
+            inflight.wait(timeout=310)
+            cached_content = self._get_from_cache(cache_key)
             if cached_content:
-                # Return cached result
-                yield self.create_json_message(cached_content)
-                return
+                return cached_content
 
-            # Clean up expired cache entries periodically
-            self._cleanup_expired_cache()
+        try:
+            # A previous leader may have finished between the cache check and registration
+            if inflight is None:
+                cached_content = self._get_from_cache(cache_key)
+                if cached_content:
+                    return cached_content
+
+            # Reuse the encoding if this file was recently sent with another schema
+            base64_data = self._get_encoded(file_hash)
+            if base64_data is None:
+                # Get file content directly from blob
+                try:
+                    file_content = file_obj.blob
+                except Exception as e:
+                    raise ValueError(f"Error reading file: {str(e)}")
+                if not file_content:
+                    raise ValueError("Error: Failed to read file content.")
 
-            # Convert file to base64
-            base64_data = base64.b64encode(file_content).decode('utf-8')
+                # The encoded output is pure ASCII, so decode it directly
+                base64_data = base64.b64encode(file_content).decode('ascii')
+                del file_content
+                self._save_encoded(file_hash, base64_data)
 
             # Determine MIME type based on filename
-            mime_type = "image/png"
-            if filename.lower().endswith(('.jpg', '.jpeg')):
-                mime_type = "image/jpeg"
-            elif filename.lower().endswith('.pdf'):
-                mime_type = "application/pdf"
-            elif filename.lower().endswith('.png'):
-                mime_type = "image/png"
+            mime_type = _MIME_BY_EXT.get(os.path.splitext(filename)[1].lower(), "image/png")
 
-            # Build JSON Schema for API
-            json_schema = self._build_json_schema(field_definitions)
+            # Build the base64 data URL in one pass
+            data_url = "data:" + mime_type + ";base64," + base64_data
+            del base64_data
 
             # Prepare API request
             url = "https://api.upstage.ai/v1/information-extraction"
@@ -203,7 +394,7 @@ class UpstageInformationExtractTool(Tool):
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:{mime_type};base64,{base64_data}"
+                                    "url": data_url
                                 }
                             }
                         ]
@@ -220,56 +411,160 @@ class UpstageInformationExtractTool(Tool):
 
             # Make API request
             try:
-                response = requests.post(
+                response = _http.request(
+                    "POST",
                     url,
                     headers=headers,
-                    json=payload,
-                    timeout=300
+                    body=orjson.dumps(payload),
+                    timeout=self._request_timeout
                 )
+                del data_url, payload
+            except urllib3.exceptions.HTTPError as e:
+                raise ValueError(f"Error: Failed to connect to Upstage API: {str(e)}")
 
-                if response.status_code != 200:
-                    error_msg = f"API request failed with status {response.status_code}"
-                    if response.text:
-                        error_msg += f": {response.text}"
-                    yield self.create_text_message(f"Error: {error_msg}")
-                    return
-
-            except requests.RequestException as e:
-                yield self.create_text_message(f"Error: Failed to connect to Upstage API: {str(e)}")
-                return
+            if response.status != 200:
+                error_msg = f"API request failed with status {response.status}"
+                if response.data:
+                    error_msg += f": {response.data.decode('utf-8', errors='replace')}"
+                raise ValueError(f"Error: {error_msg}")
 
             # Parse API response
             try:
-                result_data = response.json()
+                result_data = orjson.loads(response.data)
 
                 # Extract the content from OpenAI-compatible response format
                 if 'choices' in result_data and len(result_data['choices']) > 0:
                     message_content = result_data['choices'][0].get('message', {}).get('content', '')
-                    if message_content:
-                        extracted_data = json.loads(message_content)
-                    else:
-                        yield self.create_text_message("Error: No content in API response.")
-                        return
                 else:
-                    yield self.create_text_message("Error: Unexpected API response format.")
-                    return
+                    message_content = None
+                extracted_data = orjson.loads(message_content) if message_content else None
+            except orjson.JSONDecodeError as e:
+                raise ValueError(f"Error: Failed to parse API response as JSON: {str(e)}")
+            except Exception as e:
+                raise ValueError(f"Error: Failed to process API response: {str(e)}")
+
+            if message_content is None:
+                raise ValueError("Error: Unexpected API response format.")
+            if not message_content:
+                raise ValueError("Error: No content in API response.")
+            if not extracted_data:
+                raise ValueError("Error: No data was extracted from the document.")
+
+            # Save to cache before returning
+            self._save_to_cache(cache_key, extracted_data)
+            return extracted_data
+        finally:
+            # Only the caller that registered the request releases it
+            if inflight is None:
+                self._end_inflight(cache_key)
+
+    def _extract_batch(self, files: list, schema_text: str, json_schema: dict, api_key: str) -> dict:
+        """
+        Extract structured information from several files concurrently
 
-                if not extracted_data:
-                    yield self.create_text_message("Error: No data was extracted from the document.")
-                    return
+        Args:
+            files: File objects to be analyzed
+            schema_text: JSON string defining fields to extract
+            json_schema: JSON Schema object for API request
+            api_key: Upstage API key
+
+        Returns:
+            Dictionary mapping each filename to its extracted data, or to an
+            {"error": message} object if that file failed
+        """
+        def extract(file_obj: Any) -> dict:
+            try:
+                return self._extract_one(file_obj, schema_text, json_schema, api_key)
+            except Exception as e:
+                return {"error": str(e)}
+
+        max_workers = min(self._max_batch_workers, len(files))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            extracted = list(executor.map(extract, files))
+
+        results = {}
+        for index, (file_obj, data) in enumerate(zip(files, extracted)):
+            name = getattr(file_obj, 'filename', None) or 'document'
+            # Keep every result even when filenames repeat or clash with a generated name
+            key = name
+            suffix = index
+            while key in results:
+                key = f"{name} ({suffix})"
+                suffix += 1
+            results[key] = data
+        return results
+
+    def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage, None, None]:
+        """
+        Extract structured information from documents using Upstage Information Extract API
+
+        Args:
+            tool_parameters: Dictionary containing:
+                - file: File object to be analyzed
+                - files: Optional list of file objects to be analyzed in one batch
+                - extraction_schema: JSON string defining fields to extract
+
+        Yields:
+            ToolInvokeMessage: JSON message with extracted data, keyed by filename in batch mode
+        """
+        try:
+            # Extract parameters
+            file_obj = tool_parameters.get("file")
+            batch_files = tool_parameters.get("files") or []
+            if not file_obj and not batch_files:
+                yield self.create_text_message("Error: No file provided for extraction.")
+                return
 
-                # Save to cache before returning
-                self._save_to_cache(cache_key, extracted_data)
+            schema_text = tool_parameters.get("extraction_schema", "")
+            if not schema_text:
+                yield self.create_text_message("Error: No extraction schema provided.")
+                return
 
-                # Return result as JSON message
-                yield self.create_json_message(extracted_data)
+            # Get API key from credentials
+            api_key = self.runtime.credentials.get("upstage_api_key")
+            if not api_key:
+                yield self.create_text_message("Error: Upstage API key not found in credentials.")
+                return
 
-            except json.JSONDecodeError as e:
-                yield self.create_text_message(f"Error: Failed to parse API response as JSON: {str(e)}")
+            # Parse extraction schema
+            try:
+                field_definitions, json_schema = self._compile_schema(schema_text)
+                if not field_definitions:
+                    yield self.create_text_message("Error: Extraction schema is empty.")
+                    return
+            except ValueError as e:
+                yield self.create_text_message(f"Error parsing schema: {str(e)}")
                 return
-            except Exception as e:
-                yield self.create_text_message(f"Error: Failed to process API response: {str(e)}")
+
+            if batch_files:
+                files = ([file_obj] if file_obj else []) + list(batch_files)
+                if len(files) > self._max_batch_files:
+                    yield self.create_text_message(
+                        f"Error: Batch mode accepts at most {self._max_batch_files} files."
+                    )
+                    return
+                # The size limit is what keeps a batch within the memory budget,
+                # so files without a declared size cannot be accepted
+                sizes = [getattr(f, 'size', None) for f in files]
+                if any(size is None for size in sizes):
+                    yield self.create_text_message("Error: Batch mode requires every file to have a known size.")
+                    return
+                if sum(sizes) > self._max_batch_bytes:
+                    yield self.create_text_message(
+                        f"Error: Batch files exceed the {self._max_batch_bytes // (1024 * 1024)} MB total size limit."
+                    )
+                    return
+                yield self.create_json_message(self._extract_batch(files, schema_text, json_schema, api_key))
+                return
+
+            try:
+                extracted_data = self._extract_one(file_obj, schema_text, json_schema, api_key)
+            except ValueError as e:
+                yield self.create_text_message(str(e))
                 return
 
+            # Return result as JSON message
+            yield self.create_json_message(extracted_data)
+
         except Exception as e:
             yield self.create_text_message(f"Error: An unexpected error occurred: {str(e)}")
@@ -1,68 +1,234 @@
+from collections import OrderedDict
 from collections.abc import Generator
 from typing import Any
-import requests
+import urllib3
 import hashlib
 import time
 import threading
+import tempfile
+import stat
+import zlib
+import os
+from diskcache import Cache
 
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
 
+# Shared connection pool so keep-alive connections to api.upstage.ai are reused
+# across invocations instead of paying a fresh TCP+TLS handshake each time.
+# Only connection failures are retried: retrying the POST itself after a 5xx or
+# read error could bill the same document twice
+_http = urllib3.PoolManager(
+    num_pools=20,
+    maxsize=50,
+    block=False,
+    retries=urllib3.Retry(total=2, backoff_factor=0.3, read=0, status=0)
+)
+
+
+def _open_disk_cache() -> Cache | None:
+    """Open the on-disk cache in a private directory owned by this user, if possible"""
+    try:
+        root = os.path.join(tempfile.gettempdir(), f"upstage_cache_{os.getuid()}")
+        os.makedirs(root, mode=0o700, exist_ok=True)
+        # diskcache stores pickles, so refuse a directory anyone else could have planted or can read
+        info = os.lstat(root)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            return None
+        cache = Cache(
+            os.path.join(root, "document-parser"),
+            size_limit=1 << 30,
+            eviction_policy="least-recently-used"
+        )
+    except Exception:
+        return None
+    # Reading an expired key does not delete it, so drop rows left by earlier workers
+    try:
+        cache.expire()
+    except Exception:
+        pass
+    return cache
+
+
+# Second cache tier that survives plugin worker restarts
+_disk_cache = _open_disk_cache()
+
+# Number of independently locked memory cache shards (power of two)
+_CACHE_SHARDS = 16
+
+
 class UpstageDocumentParserTool(Tool):
-    # Class-level memory cache
-    _cache = {}
-    _cache_lock = threading.Lock()
+    # Class-level memory cache, sharded by key so lookups on different keys don't contend
+    _cache_shards: list[OrderedDict[str, dict]] = [OrderedDict() for _ in range(_CACHE_SHARDS)]
+    _cache_locks = [threading.Lock() for _ in range(_CACHE_SHARDS)]
+    _cache_shard_bytes = [0] * _CACHE_SHARDS  # Total stored size per shard
     _cache_ttl = 3600  # 1 hour cache TTL
-    _max_cache_size = 100  # Maximum number of cached items
+    _max_cache_bytes = 64 * 1024 * 1024  # Memory budget for cached contents
+    _max_cache_size = 500  # Maximum number of cached items
+    _compress_min_size = 4096  # Smaller contents are cached uncompressed
+    _cleanup_interval = 60  # Minimum seconds between expired-entry sweeps
+    _last_cleanup = 0.0
+    _cleanup_lock = threading.Lock()
+    _request_timeout = urllib3.Timeout(connect=10, read=300)
+    # Events for API calls currently in progress, keyed by cache key
+    _inflight: dict[str, threading.Event] = {}
+    _inflight_lock = threading.Lock()
+
+    # Map output format to API parameter (must be JSON string format)
+    _format_mapping = {
+        "markdown": '["markdown"]',
+        "html": '["html"]',
+        "text": '["text"]'
+    }
 
     @classmethod
-    def _get_cache_key(cls, file_content: bytes, output_format: str) -> str:
-        """Generate cache key from file content and output format"""
-        file_hash = hashlib.md5(file_content).hexdigest()
+    def _get_cache_key(cls, file_hash: str, output_format: str) -> str:
+        """Generate cache key from file content hash and output format"""
         return f"{file_hash}_{output_format}"
 
+    @staticmethod
+    def _hash_file(file_obj: Any) -> str:
+        """Hash file content (Dify files only expose the fully loaded .blob)"""
+        return hashlib.blake2b(file_obj.blob, digest_size=16).hexdigest()
+
+    @classmethod
+    def _compress(cls, content: str) -> str | bytes:
+        """Compress parsed content for caching, leaving small contents as-is"""
+        if len(content) < cls._compress_min_size:
+            return content
+        return zlib.compress(content.encode('utf-8'), 1)
+
+    @staticmethod
+    def _decompress(stored: str | bytes) -> str:
+        """Restore parsed content stored by _compress"""
+        if isinstance(stored, bytes):
+            return zlib.decompress(stored).decode('utf-8')
+        return stored
+
+    @classmethod
+    def _shard_of(cls, cache_key: str) -> int:
+        """Return the index of the memory cache shard holding the key"""
+        return hash(cache_key) & (_CACHE_SHARDS - 1)
+
     @classmethod
     def _get_from_cache(cls, cache_key: str) -> str | None:
-        """Retrieve content from memory cache if valid"""
-        with cls._cache_lock:
-            if cache_key in cls._cache:
-                cached_item = cls._cache[cache_key]
+        """Retrieve content from memory cache, falling back to disk cache"""
+        index = cls._shard_of(cache_key)
+        shard = cls._cache_shards[index]
+        with cls._cache_locks[index]:
+            if cache_key in shard:
+                cached_item = shard[cache_key]
                 # Check if cache is still valid
                 if time.time() - cached_item['timestamp'] < cls._cache_ttl:
-                    return cached_item['content']
+                    # Mark as most recently used
+                    shard.move_to_end(cache_key)
+                    return cls._decompress(cached_item['content'])
                 else:
                     # Remove expired cache
-                    del cls._cache[cache_key]
-        return None
+                    del shard[cache_key]
+                    cls._cache_shard_bytes[index] -= len(cached_item['content'])
+
+        if _disk_cache is None:
+            return None
+        try:
+            content, expire_time = _disk_cache.get(cache_key, expire_time=True)
+            if content is None:
+                return None
+            parsed_content = cls._decompress(content)
+        except Exception:
+            # The disk tier is best-effort; treat failures as a miss
+            return None
+        # Promote to the memory cache, keeping the original expiry
+        timestamp = expire_time - cls._cache_ttl if expire_time else time.time()
+        cls._save_to_memory(cache_key, content, timestamp)
+        return parsed_content
 
     @classmethod
     def _save_to_cache(cls, cache_key: str, content: str) -> None:
-        """Save content to memory cache"""
-        with cls._cache_lock:
-            # Implement LRU-style cache size management
-            if len(cls._cache) >= cls._max_cache_size:
-                # Remove oldest cache entry
-                oldest_key = min(cls._cache.keys(),
-                               key=lambda k: cls._cache[k]['timestamp'])
-                del cls._cache[oldest_key]
-
-            cls._cache[cache_key] = {
+        """Save content to memory and disk cache"""
+        stored = cls._compress(content)
+        cls._save_to_memory(cache_key, stored, time.time())
+        if _disk_cache is not None:
+            try:
+                _disk_cache.set(cache_key, stored, expire=cls._cache_ttl)
+            except Exception:
+                # The disk tier is best-effort; the memory tier still has the entry
+                pass
+
+    @classmethod
+    def _save_to_memory(cls, cache_key: str, content: str | bytes, timestamp: float) -> None:
+        """Save content to memory cache, keeping each shard within its byte and entry budget"""
+        index = cls._shard_of(cache_key)
+        shard = cls._cache_shards[index]
+        max_shard_size = cls._max_cache_size // _CACHE_SHARDS + 1
+        max_shard_bytes = cls._max_cache_bytes // _CACHE_SHARDS
+        size = len(content)
+        with cls._cache_locks[index]:
+            previous = shard.pop(cache_key, None)
+            if previous is not None:
+                cls._cache_shard_bytes[index] -= len(previous['content'])
+
+            # Contents larger than a whole shard stay on the disk tier only
+            if size > max_shard_bytes:
+                return
+
+            # Evict least recently used entries in this shard until the new one fits
+            while shard and (
+                len(shard) >= max_shard_size
+                or cls._cache_shard_bytes[index] + size > max_shard_bytes
+            ):
+                _, evicted = shard.popitem(last=False)
+                cls._cache_shard_bytes[index] -= len(evicted['content'])
+
+            shard[cache_key] = {
                 'content': content,
-                'timestamp': time.time()
+                'timestamp': timestamp
             }
+            cls._cache_shard_bytes[index] += size
+
+    @classmethod
+    def _begin_inflight(cls, cache_key: str) -> threading.Event | None:
+        """Register an in-flight request, or return the event of one already running"""
+        with cls._inflight_lock:
+            event = cls._inflight.get(cache_key)
+            if event is None:
+                cls._inflight[cache_key] = threading.Event()
+            return event
+
+    @classmethod
+    def _end_inflight(cls, cache_key: str) -> None:
+        """Release callers waiting on an in-flight request"""
+        with cls._inflight_lock:
+            event = cls._inflight.pop(cache_key, None)
+        if event is not None:
+            event.set()
 
     @classmethod
     def _cleanup_expired_cache(cls) -> None:
-        """Clean up expired cache entries"""
-        with cls._cache_lock:
-            current_time = time.time()
-            expired_keys = [
-                key for key, value in cls._cache.items()
-                if current_time - value['timestamp'] >= cls._cache_ttl
-            ]
-            for key in expired_keys:
-                del cls._cache[key]
+        """Clean up expired cache entries, at most once per cleanup interval"""
+        current_time = time.time()
+        with cls._cleanup_lock:
+            # Lookups already drop expired entries lazily, so a full sweep is rarely needed
+            if current_time - cls._last_cleanup < cls._cleanup_interval:
+                return
+            cls._last_cleanup = current_time
+
+        for index, (shard, lock) in enumerate(zip(cls._cache_shards, cls._cache_locks)):
+            with lock:
+                expired_keys = [
+                    key for key, value in shard.items()
+                    if current_time - value['timestamp'] >= cls._cache_ttl
+                ]
+                for key in expired_keys:
+                    cls._cache_shard_bytes[index] -= len(shard.pop(key)['content'])
+
+        # diskcache only culls a few expired rows per write, so remove the rest explicitly
+        if _disk_cache is not None:
+            try:
+                _disk_cache.expire()
+            except Exception:
+                pass
 
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage, None, None]:
         """
@@ -94,18 +260,15 @@ class UpstageDocumentParserTool(Tool):
                 yield self.create_text_message("Error: Upstage API key not found in credentials.")
                 return
 
-            # Get file content directly from blob
+            # Hash the file first so cache hits skip the request preparation and API call
             try:
-                file_content = file_obj.blob
-                if not file_content:
-                    yield self.create_text_message("Error: Failed to read file content.")
-                    return
+                file_hash = self._hash_file(file_obj)
             except Exception as e:
                 yield self.create_text_message(f"Error reading file: {str(e)}")
                 return
 
             # Generate cache key and check cache
-            cache_key = self._get_cache_key(file_content, output_format)
+            cache_key = self._get_cache_key(file_hash, output_format)
             cached_content = self._get_from_cache(cache_key)
 
             if cached_content:
@@ -116,83 +279,111 @@ class UpstageDocumentParserTool(Tool):
             # Clean up expired cache entries periodically
             self._cleanup_expired_cache()
 
-            # Prepare API request
-            url = "https://api.upstage.ai/v1/document-digitization"
-            headers = {
-                "Authorization": f"Bearer {api_key}"
-            }
-
-            # Map output format to API parameter (must be JSON string format)
-            format_mapping = {
-                "markdown": '["markdown"]',
-                "html": '["html"]',
-                "text": '["text"]'
-            }
-            output_formats = format_mapping.get(output_format, '["markdown"]')
-
-            # Prepare multipart form data
-            files_data = {
-                'document': (filename, file_content)
-            }
-            data = {
-                'model': 'document-parse',
-                'output_formats': output_formats,
-                'ocr': 'auto',
-                'chart_recognition': 'true',
-                'merge_multipage_tables': 'false',
-                'coordinates': 'true',
-                'base64_encoding': '[]'
-            }
+            # Wait for an identical request already in progress instead of repeating it
+            inflight = self._begin_inflight(cache_key)
+            if inflight is not None:
+                inflight.wait(timeout=310)
+                cached_content = self._get_from_cache(cache_key)
+                if cached_content:
+                    yield self.create_text_message(cached_content)
+                    return
 
-            # Make API request
             try:
-                response = requests.post(
-                    url,
-                    headers=headers,
-                    files=files_data,
-                    data=data,
-                    timeout=300
-                )
-
-                if response.status_code != 200:
-                    error_msg = f"API request failed with status {response.status_code}"
-                    if response.text:
-                        error_msg += f": {response.text}"
-                    yield self.create_text_message(f"Error: {error_msg}")
+                # A previous leader may have finished between the cache check and registration
+                if inflight is None:
+                    cached_content = self._get_from_cache(cache_key)
+                    if cached_content:
+                        yield self.create_text_message(cached_content)
+                        return
+
+                # Get file content directly from blob
+                try:
+                    file_content = file_obj.blob
+                    if not file_content:
+                        yield self.create_text_message("Error: Failed to read file content.")
+                        return
+                except Exception as e:
+                    yield self.create_text_message(f"Error reading file: {str(e)}")
                     return
 
-            except requests.RequestException as e:
-                yield self.create_text_message(f"Error: Failed to connect to Upstage API: {str(e)}")
-                return
+                # Prepare API request
+                url = "https://api.upstage.ai/v1/document-digitization"
+                headers = {
+                    "Authorization": f"Bearer {api_key}"
+                }
 
-            # Parse API response
-            try:
-                result_data = response.json()
-                content = result_data.get('content', {})
-
-                # Get the parsed content based on selected format
-                if output_format == "markdown":
-                    parsed_content = content.get('markdown', '')
-                elif output_format == "html":
-                    parsed_content = content.get('html', '')
-                elif output_format == "text":
-                    parsed_content = content.get('text', '')
-                else:
-                    parsed_content = content.get('markdown', '')
+                output_formats = self._format_mapping.get(output_format, '["markdown"]')
+
+                # Prepare multipart form data
+                fields = {
+                    'document': (filename, file_content),
+                    'model': 'document-parse',
+                    'output_formats': output_formats,
+                    'ocr': 'auto',
+                    'chart_recognition': 'true',
+                    'merge_multipage_tables': 'false',
+                    'coordinates': 'true',
+                    'base64_encoding': '[]'
+                }
 
-                if not parsed_content:
-                    yield self.create_text_message("Error: No content was extracted from the document.")
+                # Make API request
+                try:
+                    response = _http.request(
+                        "POST",
+                        url,
+                        headers=headers,
+                        fields=fields,
+                        timeout=self._request_timeout
+                    )
+                    del file_content, fields
+
+                    if response.status != 200:
+                        error_msg = f"API request failed with status {response.status}"
+                        if response.data:
+                            error_msg += f": {response.data.decode('utf-8', errors='replace')}"
+                        yield self.create_text_message(f"Error: {error_msg}")
+                        return
+
+                except urllib3.exceptions.HTTPError as e:
+                    yield self.create_text_message(f"Error: Failed to connect to Upstage API: {str(e)}")
                     return
 
-                # Save to cache before returning
-                self._save_to_cache(cache_key, parsed_content)
+                # Parse API response
+                try:
+                    result_data = response.json()
+                    content = result_data.get('content', {})
 
-                # Return result as text message
-                yield self.create_text_message(parsed_content)
+                    # Get the parsed content based on selected format
+                    if output_format == "markdown":
+                        parsed_content = content.get('markdown', '')
+                    elif output_format == "html":
+                        parsed_content = content.get('html', '')
+                    elif output_format == "text":
+                        parsed_content = content.get('text', '')
+                    else:
+                        parsed_content = content.get('markdown', '')
 
-            except Exception as e:
-                yield self.create_text_message(f"Error: Failed to parse API response: {str(e)}")
-                return
+                    if not parsed_content:
+                        yield self.create_text_message("Error: No content was extracted from the document.")
+                        return
+
+                    # Save to cache before returning
+                    self._save_to_cache(cache_key, parsed_content)
+
+                    # Release waiting callers now rather than when the consumer resumes us
+                    if inflight is None:
+                        self._end_inflight(cache_key)
+
+                    # Return result as text message
+                    yield self.create_text_message(parsed_content)
+
+                except Exception as e:
+                    yield self.create_text_message(f"Error: Failed to parse API response: {str(e)}")
+                    return
+            finally:
+                # Only the caller that registered the request releases it (no-op if already released)
+                if inflight is None:
+                    self._end_inflight(cache_key)
 
         except Exception as e:
             yield self.create_text_message(f"Error: An unexpected error occurred: {str(e)}")